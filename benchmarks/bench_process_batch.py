@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+'''
+benchmark the pysigfish classification hot path
+
+sweeps engine and batch parameters over start.process_batch (read objects
+with bytes raw_data, as read until delivers them) or start.process_arrays
+with synthetic picoamp signal, recording init_sigfish startup time, per-batch latency
+percentiles, samples/second and peak RSS for each configuration. Each
+configuration runs in a fresh process so startup and RSS are not shared.
+Results are written as JSON and can be compared against an earlier run
+
+    bench_process_batch.py -r ref.fa -c 128,512 -t 1,8 --api batch,arrays -o run.json
+    bench_process_batch.py -r ref.fa -o new.json --compare run.json
+'''
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+from queue import Empty
+import numpy as np
+import pysigfish
+
+
+class MyParser(argparse.ArgumentParser):
+    def error(self, message):
+        sys.stderr.write('error: %s\n' % message)
+        self.print_help()
+        sys.exit(2)
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def peak_rss_kb():
+    '''
+    peak resident set size of this process in KiB
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, linux KiB
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+class Read:
+    '''
+    read until style read object for process_batch
+    '''
+
+    def __init__(self, id, number, raw_data):
+        self.id = id
+        self.number = number
+        self.chunk_length = len(raw_data) // 4
+        self.raw_data = raw_data
+
+
+def run_config(config, batches, warmup, seed, queue):
+    '''
+    run one configuration and put its result on queue
+    '''
+    rng = np.random.default_rng(seed)
+    channels = config['channels']
+    chunk_size = config['chunk_size']
+    # reads still undecided at twice the query window are forced to a decision
+    max_read_samples = 2 * config['query_size_sig']
+
+    t0 = time.perf_counter()
+    sf = pysigfish.start(config['reference'], '-', channels=channels, threads=config['threads'],
+                         query_size_sig=config['query_size_sig'], query_size_events=config['query_size_events'],
+                         max_read_samples=max_read_samples)
+    init_time = time.perf_counter() - t0
+
+    # a channel moves on to a new read as soon as its read is decided, so no
+    # chunk is answered from the decision cache and every batch reaches sigfish
+    chans = np.arange(1, channels + 1, dtype=np.int32)
+    offsets = np.arange(channels + 1, dtype=np.int64) * chunk_size
+    read_numbers = np.zeros(channels, dtype=np.int32)
+    latencies = []
+    for b in range(warmup + batches):
+        read_ids = ['{}_{}'.format(c, n) for c, n in zip(chans, read_numbers)]
+        signal = rng.normal(90.0, 15.0, channels * chunk_size).astype(np.float32)
+        if config['api'] == 'batch':
+            batch = [[int(c), Read(rid, int(n), signal[o:o+chunk_size].tobytes())]
+                     for c, n, rid, o in zip(chans, read_numbers, read_ids, offsets)]
+        if b == warmup:
+            sf.reset_stats()
+        t1 = time.perf_counter()
+        if config['api'] == 'batch':
+            result = sf.process_batch(batch, np.float32)
+            status = np.array([result[c][3] for c in chans.tolist()], dtype=np.int8)
+        else:
+            status = sf.process_arrays(chans, read_numbers, read_ids, signal, offsets)
+        t2 = time.perf_counter()
+        # only batches sigfish actually worked on count towards latency
+        if b >= warmup and sf.stats()['last']['reads'] > 0:
+            latencies.append(t2 - t1)
+        # 0 is SIGFISH_MORE
+        read_numbers[status != 0] += 1
+
+    if not latencies:
+        raise RuntimeError("no timed batch reached sigfish")
+    latencies = np.array(latencies)
+    total = latencies.sum()
+    stats = sf.stats()['total']
+    result = dict(config)
+    result.update({
+        'batches': len(latencies),
+        'max_read_samples': max_read_samples,
+        'init_time_s': init_time,
+        'latency_s': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        },
+        # samples sigfish was given, not what the batches carried
+        'samples_per_second': stats['samples'] / total if total > 0 else 0.0,
+        'peak_rss_kb': peak_rss_kb(),
+        'reads_to_sigfish': stats['reads'],
+        'cache_hits': stats['cache_hits'],
+    })
+    queue.put(result)
+
+
+def wait_result(p, queue, timeout):
+    '''
+    result of the configuration running in p, or an error string if it
+    died or ran past timeout seconds
+    '''
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            pass
+        if not p.is_alive():
+            # it may have put its result just before exiting
+            try:
+                return queue.get(timeout=1)
+            except Empty:
+                return "exited with code {}".format(p.exitcode)
+        if time.perf_counter() > deadline:
+            p.terminate()
+            return "timed out after {}s".format(timeout)
+
+
+def compare(results, baseline, tolerance):
+    '''
+    print configurations whose p50 latency regressed past tolerance, returns
+    the number of regressions
+    '''
+    keys = ('api', 'reference', 'channels', 'threads', 'query_size_sig', 'query_size_events', 'chunk_size')
+    # runs from before the api axis only timed process_arrays
+    key = lambda r: tuple(r.get(k, 'arrays') if k == 'api' else r[k] for k in keys)
+    old = {key(r): r for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        b = old.get(key(r))
+        if b is None or 'error' in r or 'error' in b:
+            continue
+        ratio = r['latency_s']['p50'] / b['latency_s']['p50']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions += 1
+        print(*(r[k] for k in keys), "p50 {:.2f}x".format(ratio), flag, sep='\t')
+    return regressions
+
+
+def main():
+
+    parser = MyParser(description="benchmark pysigfish process_batch and process_arrays",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-r", "--reference", nargs='+', required=True,
+                        help="reference fasta(s), several sweep reference size")
+    parser.add_argument("--api", type=lambda v: v.split(','), default=['batch'],
+                        help="comma separated entry points to time: batch (process_batch) and/or arrays (process_arrays)")
+    parser.add_argument("-c", "--channels", type=int_list, default=[512],
+                        help="comma separated channel counts")
+    parser.add_argument("-t", "--threads", type=int_list, default=[8],
+                        help="comma separated thread counts")
+    parser.add_argument("--query-size-sig", type=int_list, default=[6000],
+                        help="comma separated query_size_sig values")
+    parser.add_argument("--query-size-events", type=int_list, default=[250],
+                        help="comma separated query_size_events values")
+    parser.add_argument("--chunk-size", type=int_list, default=[1600],
+                        help="comma separated samples per channel per batch")
+    parser.add_argument("-b", "--batches", type=int, default=50,
+                        help="timed batches per configuration")
+    parser.add_argument("-w", "--warmup", type=int, default=5,
+                        help="untimed batches before timing")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="signal random seed")
+    parser.add_argument("--timeout", type=float, default=3600,
+                        help="seconds before a configuration is given up on")
+    parser.add_argument("-o", "--output", default="bench.json",
+                        help="json results file")
+    parser.add_argument("--compare",
+                        help="earlier json results to compare p50 latency against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed p50 slowdown before flagging a regression")
+
+    args = parser.parse_args()
+    for api in args.api:
+        if api not in ('batch', 'arrays'):
+            parser.error("--api takes batch and/or arrays, not '{}'".format(api))
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    failed = 0
+    for api, ref, channels, threads, qss, qse, chunk in itertools.product(args.api, args.reference, args.channels, args.threads, args.query_size_sig, args.query_size_events, args.chunk_size):
+        config = {'api': api, 'reference': ref, 'channels': channels, 'threads': threads,
+                  'query_size_sig': qss, 'query_size_events': qse, 'chunk_size': chunk}
+        queue = ctx.Queue()
+        p = ctx.Process(target=run_config, args=(config, args.batches, args.warmup, args.seed, queue))
+        p.start()
+        result = wait_result(p, queue, args.timeout)
+        p.join()
+        if isinstance(result, str):
+            # a bad reference or a crash, record it and carry on with the sweep
+            failed += 1
+            results.append(dict(config, error=result))
+            print(api, ref, channels, threads, qss, qse, chunk, "FAILED: " + result, sep='\t')
+            continue
+        results.append(result)
+        print(api, ref, channels, threads, qss, qse, chunk,
+              "init {:.2f}s".format(result['init_time_s']),
+              "p50 {:.1f}ms".format(result['latency_s']['p50'] * 1000),
+              "p99 {:.1f}ms".format(result['latency_s']['p99'] * 1000),
+              "{:.0f} samples/s".format(result['samples_per_second']),
+              "{} KiB".format(result['peak_rss_kb']),
+              "{} cache hits".format(result['cache_hits']), sep='\t')
+
+    out = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(),
+            'machine': platform.machine(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
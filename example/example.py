@@ -41,11 +41,11 @@ def real_main2(args):
         records.append(rec)
 
     # pysig = pysigfish.start(args.reference, args.paf, channels=channels, threads=args.threads, DEBUG=1)
-    pysig = pysigfish.start(args.reference, args.paf, channels=channels, threads=1, DEBUG=1)
+    # decisions.tsv is written on a background thread, off the batch path
+    pysig = pysigfish.start(args.reference, args.paf, channels=channels, threads=1, DEBUG=1, decision_log='decisions.tsv')
     batch = []
     dddtype = 'f'
     round = 0
-    F = open('decisions.tsv', 'w')
     print("round: {}".format(round))
     C = 0
     G = 0
@@ -59,18 +59,12 @@ def real_main2(args):
             # print("channel: {}".format(channel))
             if C == 512:
                 status = pysig.process_batch(batch, dddtype)
-                for ch in status.keys():
-                    read_number = status[ch][1]
-                    read_id = status[ch][2]
-                    decision = status[ch][3]
-                    print(read_id, ch, read_number, decision, sep='\t', file=F)
                 C = 0
                 round += 1
                 batch = []
                 print("round: {}".format(round))
                 break
     print("done!")
-    F.close()
     s5.close()
 
 
@@ -88,34 +82,34 @@ def real_main3(args):
     for rec in recs:
         records.append(rec)
 
-    pysig = pysigfish.start(args.reference, args.paf, channels=CHANNELS, threads=args.threads, DEBUG=1)
-    batch = []
-    dddtype = 'f'
-    F = open('decisions.tsv', 'w')
+    pysig = pysigfish.start(args.reference, args.paf, channels=CHANNELS, threads=args.threads, DEBUG=1, decision_log='decisions.tsv')
     for round in range(ROUNDS):
         print("round: {}".format(round))
+        channels = []
+        read_ids = []
+        chunks = []
         for channel in range(CHANNELS):
             # print(records[channel+1]["read_id"])
             print("chunks in read {} {} chunks:{} total:{}".format(records[channel+1]["read_id"], channel+1, (round+1)*CHUNK_SIZE, records[channel+1]['len_raw_signal']))
             if (round+1)*CHUNK_SIZE >= records[channel+1]['len_raw_signal']:
                 print("No more chunks in read {} {} chunks:{} total:{}".format(records[channel+1]["read_id"], channel+1, (round+1)*CHUNK_SIZE, records[channel+1]['len_raw_signal']))
                 continue
-            read = RUread(records[channel+1]["read_id"], 0, CHUNK_SIZE, records[channel+1]["signal"][CHUNK_SIZE*round:(CHUNK_SIZE*(round+1))+1])
-            batch.append([channel+1, read])
+            channels.append(channel+1)
+            read_ids.append(records[channel+1]["read_id"])
+            chunks.append(records[channel+1]["signal"][CHUNK_SIZE*round:CHUNK_SIZE*(round+1)])
             # print("channel: {}".format(channel))
-        # for i, j in batch:
-            # print(j.id, i, j.number)
-        status = pysig.process_batch(batch, dddtype)
-
-        for ch in status.keys():
-            read_number = status[ch][1]
-            read_id = status[ch][2]
-            decision = status[ch][3]
-            # print(read_id, ch, read_number, decision, sep='\t', file=F)
+        if not channels:
+            continue
+        # columnar batch: one concatenated signal array with CSR offsets
+        signal = np.concatenate(chunks).astype(np.float32)
+        offsets = np.zeros(len(chunks)+1, dtype=np.int64)
+        np.cumsum([len(c) for c in chunks], out=offsets[1:])
+        read_numbers = np.zeros(len(channels), dtype=np.int32)
+        status = pysig.process_arrays(channels, read_numbers, read_ids, signal, offsets)
+
+        for ch, read_number, read_id, decision in zip(channels, read_numbers, read_ids, status):
             print(read_id, ch, read_number, decision, sep='\t')
-        batch = []
     print("done!")
-    F.close()
     s5.close()
 
 
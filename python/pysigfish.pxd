@@ -3,7 +3,7 @@ from libc.stdio cimport *
 from libc.stdint cimport *
 from libc.stdlib cimport *
 
-cdef extern from "sigfish.h":
+cdef extern from "sigfish.h" nogil:
 
 	cdef enum sigfish_status:
 		SIGFISH_MORE = 0,      #more data needed
@@ -48,3 +48,23 @@ cdef extern from "error.h":
 		LOG_TRAC        # tracing, debugging, verbose, information, warning and error messages
 	
 	void set_log_level(sigfish_log_level_opt level);
+
+cdef extern from "slow5/slow5.h" nogil:
+
+	ctypedef struct slow5_file_t:
+		pass
+
+	ctypedef struct slow5_rec_t:
+		char* read_id;
+		double digitisation;
+		double offset;
+		double range;
+		double sampling_rate;
+		uint64_t len_raw_signal;
+		int16_t* raw_signal;
+		pass
+
+	slow5_file_t *slow5_open(const char *pathname, const char *mode);
+	int slow5_get_next(slow5_rec_t **read, slow5_file_t *s5p);
+	void slow5_rec_free(slow5_rec_t *read);
+	int slow5_close(slow5_file_t *s5p);
@@ -5,9 +5,21 @@ import sys
 import time
 import logging
 import copy
+import atexit as _atexit
+import collections
+import mmap
+import zlib
+import queue
+import threading
+import asyncio
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import Future, ThreadPoolExecutor
 from libc.stdlib cimport malloc, free
 from cpython.mem cimport PyMem_Malloc, PyMem_Realloc, PyMem_Free
-from libc.string cimport strdup
+from libc.string cimport strdup, strlen, memcpy, memset
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
 cimport pysigfish
 # Import the Python-level symbols of numpy
 import numpy as np
@@ -17,6 +29,433 @@ cimport numpy as np
 # _always_ do that, or you will have segfaults
 np.import_array()
 
+# one row per read in a batch, returned by process_batch(..., as_array=True)
+DECISION_DTYPE = np.dtype([('channel', np.int32), ('read_number', np.int32), ('status', np.int8), ('batch_index', np.int32)])
+
+cdef packed struct decision_t:
+    int32_t channel
+    int32_t read_number
+    int8_t status
+    int32_t batch_index
+
+# cumulative or last-batch counters reported by start.stats()
+cdef struct batch_stats_t:
+    uint64_t batches
+    uint64_t reads
+    uint64_t samples
+    uint64_t more
+    uint64_t reject
+    uint64_t cont
+    uint64_t forced
+    uint64_t cache_hits
+    uint64_t marshal_ns
+    uint64_t engine_ns
+    uint64_t collect_ns
+
+
+# per-channel buffers end_reads keeps for the channel's next read, anything
+# bigger is freed (samples of conversion buffer, bytes of read id)
+cdef enum:
+    _KEEP_SAMPLES = 16384
+    _KEEP_ID_BYTES = 256
+
+
+cdef inline uint64_t _now_ns() noexcept nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return <uint64_t> ts.tv_sec * 1000000000 + <uint64_t> ts.tv_nsec
+
+
+cdef class _Calibration:
+    '''
+    Per-channel ADC to picoamp calibration, pA = (raw + offset) * range / digitisation
+    '''
+    cdef int num_channels
+    cdef float *scale
+    cdef float *offset
+    cdef int8_t *is_set
+
+    def __cinit__(self, int num_channels):
+        self.num_channels = num_channels
+        self.scale = <float *> PyMem_Malloc(sizeof(float)*num_channels)
+        self.offset = <float *> PyMem_Malloc(sizeof(float)*num_channels)
+        self.is_set = <int8_t *> PyMem_Malloc(sizeof(int8_t)*num_channels)
+        if not (self.scale and self.offset and self.is_set):
+            raise MemoryError()
+        for i in range(num_channels):
+            self.scale[i] = 0
+            self.offset[i] = 0
+            self.is_set[i] = 0
+
+    def __dealloc__(self):
+        PyMem_Free(self.scale)
+        PyMem_Free(self.offset)
+        PyMem_Free(self.is_set)
+
+    cdef size_t nbytes(self):
+        return (2 * sizeof(float) + sizeof(int8_t)) * self.num_channels
+
+
+cdef inline void _to_picoamps(const int16_t *raw, float *out, uint64_t n, float scale, float offset) noexcept nogil:
+    cdef uint64_t i
+    for i in range(n):
+        out[i] = (raw[i] + offset) * scale
+
+
+cdef class _ChannelState:
+    '''
+    What the binding knows about the read currently on each channel
+    '''
+    cdef int num_channels
+    cdef int32_t *read_number
+    cdef uint64_t *samples
+    # decision cache: the last read on the channel sigfish decided, and how
+    cdef int32_t *decided_number
+    cdef int8_t *decision
+
+    def __cinit__(self, int num_channels):
+        self.num_channels = num_channels
+        self.read_number = <int32_t *> PyMem_Malloc(sizeof(int32_t)*num_channels)
+        self.samples = <uint64_t *> PyMem_Malloc(sizeof(uint64_t)*num_channels)
+        self.decided_number = <int32_t *> PyMem_Malloc(sizeof(int32_t)*num_channels)
+        self.decision = <int8_t *> PyMem_Malloc(sizeof(int8_t)*num_channels)
+        if not (self.read_number and self.samples and self.decided_number and self.decision):
+            raise MemoryError()
+        for i in range(num_channels):
+            self.clear(i)
+
+    def __dealloc__(self):
+        PyMem_Free(self.read_number)
+        PyMem_Free(self.samples)
+        PyMem_Free(self.decided_number)
+        PyMem_Free(self.decision)
+
+    cdef void clear(self, int c):
+        self.end(c)
+        self.decided_number[c] = -1
+        self.decision[c] = SIGFISH_MORE
+
+    cdef void end(self, int c):
+        '''
+        drop the channel's read but keep its cached decision, so chunks that
+        trail an unblock are still answered from the cache
+        '''
+        self.read_number[c] = -1
+        self.samples[c] = 0
+
+    cdef size_t nbytes(self):
+        return (2 * sizeof(int32_t) + sizeof(uint64_t) + sizeof(int8_t)) * self.num_channels
+
+
+cdef class _BatchArena:
+    '''
+    Reusable sigfish_read_t batch, sized to the number of channels
+
+    Conversion buffers and read ids are kept per channel and only grow, so a
+    run settles into a steady state where building a batch allocates nothing.
+    Chunks of reads sigfish has already decided are answered from the
+    channel's cached decision and never reach reads
+    '''
+    cdef sigfish_read_t *reads
+    cdef int items
+    cdef int32_t *slot
+    cdef int8_t *result
+    cdef int32_t *item_channel
+    cdef int32_t *item_number
+    cdef int num_channels
+    cdef float **sig
+    cdef uint64_t *sig_cap
+    cdef char **rid
+    cdef size_t *rid_cap
+    cdef int32_t *rid_number
+    cdef uint64_t *seen
+    cdef uint64_t seq
+    cdef readonly uint64_t growths
+    cdef list signals
+    cdef list item_ids
+    cdef list item_data
+    cdef _Calibration cal
+    cdef _ChannelState chan
+    cdef uint64_t marshal_ns
+
+    def __cinit__(self, int num_channels, _Calibration cal, _ChannelState chan):
+        self.num_channels = num_channels
+        self.cal = cal
+        self.chan = chan
+        self.items = 0
+        self.seq = 0
+        self.growths = 0
+        self.signals = []
+        self.item_ids = []
+        self.item_data = []
+        self.reads = <sigfish_read_t *> PyMem_Malloc(sizeof(sigfish_read_t)*num_channels)
+        self.sig = <float **> PyMem_Malloc(sizeof(float *)*num_channels)
+        self.sig_cap = <uint64_t *> PyMem_Malloc(sizeof(uint64_t)*num_channels)
+        self.rid = <char **> PyMem_Malloc(sizeof(char *)*num_channels)
+        self.rid_cap = <size_t *> PyMem_Malloc(sizeof(size_t)*num_channels)
+        self.rid_number = <int32_t *> PyMem_Malloc(sizeof(int32_t)*num_channels)
+        self.seen = <uint64_t *> PyMem_Malloc(sizeof(uint64_t)*num_channels)
+        self.slot = <int32_t *> PyMem_Malloc(sizeof(int32_t)*num_channels)
+        self.result = <int8_t *> PyMem_Malloc(sizeof(int8_t)*num_channels)
+        self.item_channel = <int32_t *> PyMem_Malloc(sizeof(int32_t)*num_channels)
+        self.item_number = <int32_t *> PyMem_Malloc(sizeof(int32_t)*num_channels)
+        if not (self.reads and self.sig and self.sig_cap and self.rid and self.rid_cap and self.rid_number and self.seen
+                and self.slot and self.result and self.item_channel and self.item_number):
+            raise MemoryError()
+        for i in range(num_channels):
+            self.sig[i] = NULL
+            self.sig_cap[i] = 0
+            self.rid[i] = NULL
+            self.rid_cap[i] = 0
+            self.rid_number[i] = -1
+            self.seen[i] = 0
+
+    def __dealloc__(self):
+        if self.sig is not NULL:
+            for i in range(self.num_channels):
+                PyMem_Free(self.sig[i])
+        if self.rid is not NULL:
+            for i in range(self.num_channels):
+                PyMem_Free(self.rid[i])
+        PyMem_Free(self.reads)
+        PyMem_Free(self.sig)
+        PyMem_Free(self.sig_cap)
+        PyMem_Free(self.rid)
+        PyMem_Free(self.rid_cap)
+        PyMem_Free(self.rid_number)
+        PyMem_Free(self.seen)
+        PyMem_Free(self.slot)
+        PyMem_Free(self.result)
+        PyMem_Free(self.item_channel)
+        PyMem_Free(self.item_number)
+
+    cdef float *signal_buffer(self, int c, uint64_t n) except NULL:
+        '''
+        per-channel float buffer holding at least n samples, grown geometrically
+        '''
+        cdef uint64_t cap = self.sig_cap[c]
+        cdef float *buf
+        if cap < n:
+            if cap == 0:
+                cap = 4096
+            while cap < n:
+                cap *= 2
+            buf = <float *> PyMem_Realloc(self.sig[c], sizeof(float)*cap)
+            if not buf:
+                raise MemoryError()
+            self.sig[c] = buf
+            self.sig_cap[c] = cap
+            self.growths += 1
+        return self.sig[c]
+
+    cdef char *read_id(self, int c, int32_t read_number, read_id) except NULL:
+        '''
+        per-channel read id, only rewritten when the channel's read number changes
+        '''
+        cdef bytes rid
+        cdef size_t n
+        cdef char *buf
+        if self.rid[c] is NULL or self.rid_number[c] != read_number:
+            rid = str.encode(read_id)
+            n = len(rid) + 1
+            if self.rid_cap[c] < n:
+                n = max(n, 2*self.rid_cap[c], 64)
+                buf = <char *> PyMem_Realloc(self.rid[c], n)
+                if not buf:
+                    raise MemoryError()
+                self.rid[c] = buf
+                self.rid_cap[c] = n
+                self.growths += 1
+            memcpy(self.rid[c], <char *> rid, len(rid) + 1)
+            self.rid_number[c] = read_number
+        return self.rid[c]
+
+    cdef float *picoamps(self, int c, const int16_t[::1] raw, uint64_t start, uint64_t n) except NULL:
+        '''
+        calibrate n raw ADC samples from raw[start] into the channel's buffer
+        '''
+        cdef float *buf
+        if not self.cal.is_set[c]:
+            raise ValueError("channel {} has int16 signal but no calibration, call set_calibration first".format(c + 1))
+        buf = self.signal_buffer(c, n)
+        _to_picoamps(&raw[start], buf, n, self.cal.scale[c], self.cal.offset[c])
+        return buf
+
+    cdef int fill(self, batch, signal_dtype) except -1:
+        '''
+        load a list of [channel, read] pairs into the batch, returning the
+        number of reads that need sigfish
+
+        float32 signal is referenced in place, int16 ADC samples are converted
+        to picoamps with the channel's calibration and anything else is cast
+        into the channel's buffer with one vectorised copy
+        '''
+        cdef const float[::1] sig
+        cdef float *buf
+        cdef int idx = 0
+        cdef int k = 0
+        cdef int c
+        cdef uint64_t n
+
+        self.seq += 1
+        self.items = 0
+        del self.signals[:]
+        del self.item_ids[:]
+        del self.item_data[:]
+        for channel, read in batch:
+            c = channel - 1
+            if c < 0 or c >= self.num_channels:
+                raise ValueError("channel {} outside 1..{}".format(channel, self.num_channels))
+            if self.seen[c] == self.seq:
+                raise ValueError("channel {} appears more than once in batch".format(channel))
+            self.seen[c] = self.seq
+            self.item_channel[k] = channel
+            self.item_number[k] = read.number
+            # what the result dict needs, so the batch itself is free once filled
+            self.item_ids.append(read.id)
+            self.item_data.append(read.raw_data)
+            if self.chan.decided_number[c] == read.number:
+                # already decided, answer from the cache without touching the signal
+                self.slot[k] = -1
+                self.result[k] = self.chan.decision[c]
+                k += 1
+                continue
+            self.slot[k] = idx
+            k += 1
+            n = read.chunk_length
+            arr = _signal_array(read.raw_data, signal_dtype)
+            if n > <uint64_t> arr.shape[0]:
+                raise ValueError("read {} chunk_length {} exceeds raw_data length {}".format(read.id, n, arr.shape[0]))
+            if n == 0:
+                self.reads[idx].raw_signal = NULL
+            elif arr.dtype == np.float32 and arr.flags.c_contiguous:
+                sig = arr
+                # sigfish points straight into arr, keep it alive for the call
+                self.signals.append(arr)
+                self.reads[idx].raw_signal = <float *> &sig[0]
+            elif arr.dtype == np.int16:
+                self.reads[idx].raw_signal = self.picoamps(c, np.ascontiguousarray(arr), 0, n)
+            else:
+                buf = self.signal_buffer(c, n)
+                np.copyto(np.asarray(<float[:n]> buf), arr[:n], casting='unsafe')
+                self.reads[idx].raw_signal = buf
+            self.reads[idx].read_number = read.number
+            self.reads[idx].read_id = self.read_id(c, read.number, read.id)
+            self.reads[idx].channel = channel
+            self.reads[idx].len_raw_signal = n
+            idx += 1
+        self.items = k
+        return idx
+
+    cdef int fill_arrays(self, channels, read_numbers, read_ids, signal, offsets) except -1:
+        '''
+        load a columnar batch into the arena, returning the number of reads
+        that need sigfish
+
+        read i is signal[offsets[i]:offsets[i+1]] on channels[i], so reads are
+        filled in by pointer arithmetic into the one signal array. int16 signal
+        is calibrated per channel into the channel buffers instead
+        '''
+        cdef const int32_t[::1] chans = np.ascontiguousarray(channels, dtype=np.int32)
+        cdef const int32_t[::1] numbers = np.ascontiguousarray(read_numbers, dtype=np.int32)
+        cdef const int64_t[::1] offs = np.ascontiguousarray(offsets, dtype=np.int64)
+        cdef const float[::1] sig
+        cdef const int16_t[::1] raw
+        cdef float *base = NULL
+        cdef int n = chans.shape[0]
+        cdef int i, c
+        cdef int idx = 0
+        cdef bint adc = False
+
+        arr = np.asarray(signal)
+        if arr.dtype == np.int16:
+            adc = True
+            arr = np.ascontiguousarray(arr)
+            raw = arr
+        else:
+            arr = np.ascontiguousarray(arr, dtype=np.float32)
+            sig = arr
+            base = <float *> &sig[0] if sig.shape[0] > 0 else NULL
+        if numbers.shape[0] != n or len(read_ids) != n or offs.shape[0] != n + 1:
+            raise ValueError("channels, read_numbers and read_ids need one entry per read and offsets one more")
+        if n > 0 and (offs[0] < 0 or offs[n] > arr.shape[0]):
+            raise ValueError("offsets outside signal of length {}".format(arr.shape[0]))
+
+        self.seq += 1
+        self.items = 0
+        del self.signals[:]
+        # sigfish points straight into arr, keep it alive for the call
+        self.signals.append(arr)
+        for i in range(n):
+            c = chans[i] - 1
+            if c < 0 or c >= self.num_channels:
+                raise ValueError("channel {} outside 1..{}".format(chans[i], self.num_channels))
+            if self.seen[c] == self.seq:
+                raise ValueError("channel {} appears more than once in batch".format(chans[i]))
+            self.seen[c] = self.seq
+            if offs[i+1] < offs[i]:
+                raise ValueError("offsets must be non-decreasing")
+            self.item_channel[i] = chans[i]
+            self.item_number[i] = numbers[i]
+            if self.chan.decided_number[c] == numbers[i]:
+                # already decided, answer from the cache without touching the signal
+                self.slot[i] = -1
+                self.result[i] = self.chan.decision[c]
+                continue
+            self.slot[i] = idx
+            self.reads[idx].read_number = numbers[i]
+            self.reads[idx].read_id = self.read_id(c, numbers[i], read_ids[i])
+            self.reads[idx].channel = chans[i]
+            self.reads[idx].len_raw_signal = offs[i+1] - offs[i]
+            if offs[i+1] == offs[i]:
+                self.reads[idx].raw_signal = NULL
+            elif adc:
+                self.reads[idx].raw_signal = self.picoamps(c, raw, offs[i], offs[i+1] - offs[i])
+            else:
+                self.reads[idx].raw_signal = base + offs[i]
+            idx += 1
+        self.items = n
+        return idx
+
+    cdef void drop_channel(self, int c, bint free_all):
+        '''
+        forget the channel's read id and free its conversion buffer and read
+        id, or with free_all unset keep them for the next read when they are
+        within _KEEP_SAMPLES/_KEEP_ID_BYTES
+        '''
+        if free_all or self.sig_cap[c] > _KEEP_SAMPLES:
+            PyMem_Free(self.sig[c])
+            self.sig[c] = NULL
+            self.sig_cap[c] = 0
+        if free_all or self.rid_cap[c] > _KEEP_ID_BYTES:
+            PyMem_Free(self.rid[c])
+            self.rid[c] = NULL
+            self.rid_cap[c] = 0
+        self.rid_number[c] = -1
+
+    def channel_bytes(self):
+        '''
+        bytes of conversion buffer and read id held for each channel
+        '''
+        per = np.empty(self.num_channels, dtype=np.int64)
+        cdef int64_t[::1] v = per
+        for i in range(self.num_channels):
+            v[i] = self.sig_cap[i] * sizeof(float) + self.rid_cap[i]
+        return per
+
+    cdef size_t fixed_bytes(self):
+        return (sizeof(sigfish_read_t) + sizeof(float *) + sizeof(uint64_t) + sizeof(char *) + sizeof(size_t) + sizeof(int32_t) + sizeof(uint64_t)
+                + 3 * sizeof(int32_t) + sizeof(int8_t)) * self.num_channels
+
+    cdef void release(self):
+        '''
+        drop references to caller-owned signal once sigfish is done with them
+        '''
+        del self.signals[:]
+        del self.item_ids[:]
+        del self.item_data[:]
+
+
 cdef class start:
     '''
     Creates a new sigfish object
@@ -28,8 +467,17 @@ cdef class start:
     cdef char* out_paf
     cdef int NUM_CHANNELS
     cdef int NUM_THREADS
-    cdef sigfish_read_t *sbatch
-    cdef sigfish_status *status
+    cdef list arenas
+    cdef _Calibration cal
+    cdef _ChannelState channel_state
+    cdef uint64_t max_read_samples
+    cdef batch_stats_t stats_total
+    cdef batch_stats_t stats_last
+    cdef object free_arenas
+    cdef object executor
+    cdef list worker_threads
+    cdef object log
+    cdef bint owns_log
     cdef int batch_len
     cdef object logger
     cdef char* rid
@@ -38,9 +486,10 @@ cdef class start:
     cdef float dtw_cutoff
     cdef int query_size_sig
     cdef int query_size_events
+    cdef readonly uint64_t init_ns
 
 
-    def __cinit__(self, ref, paf, channels=512, threads=8, dtw_cutoff=70.0, query_size_sig=6000, query_size_events=250, pore=0, DEBUG=0):
+    def __cinit__(self, ref, paf, channels=512, threads=8, dtw_cutoff=70.0, query_size_sig=6000, query_size_events=250, pore=0, DEBUG=0, max_inflight=2, max_read_samples=None, decision_log=None):
         '''
         C init
         '''
@@ -49,8 +498,17 @@ cdef class start:
         self.REF = NULL
         self.NUM_CHANNELS = 0
         self.NUM_THREADS = 0
-        self.sbatch = NULL
-        self.status = NULL
+        self.arenas = []
+        self.cal = None
+        self.channel_state = None
+        self.max_read_samples = 0
+        memset(&self.stats_total, 0, sizeof(batch_stats_t))
+        memset(&self.stats_last, 0, sizeof(batch_stats_t))
+        self.free_arenas = None
+        self.executor = None
+        self.worker_threads = []
+        self.log = None
+        self.owns_log = False
         self.batch_len = 0
         self.rid = NULL
         self.out_paf = NULL
@@ -107,15 +565,48 @@ cdef class start:
         self.opt.query_size_sig = self.query_size_sig
         self.opt.query_size_events = self.query_size_events
 
+        cdef uint64_t t0 = _now_ns()
         self.state = init_sigfish(self.REF, self.NUM_CHANNELS, self.opt)
+        self.init_ns = _now_ns() - t0
         if self.state is NULL:
             self.logger.error("Ref '{}' could not be opened and sigfish not initialised".format(ref))
+        else:
+            self.logger.info("sigfish initialised from '{}' in {:.2f}s".format(ref, self.init_ns / 1e9))
         
         if self.state is NULL:
             raise MemoryError()
 
+        # one arena per batch in flight: batch N+1 is marshalled into a free
+        # arena while sigfish is still working on batch N
+        if max_inflight < 1:
+            raise ValueError("max_inflight must be at least 1")
+        self.cal = _Calibration(self.NUM_CHANNELS)
+        # reads still undecided after max_read_samples are forced to a decision,
+        # 0 turns the bound off
+        self.channel_state = _ChannelState(self.NUM_CHANNELS)
+        if max_read_samples is None:
+            max_read_samples = 2 * self.query_size_sig
+        if max_read_samples < 0:
+            raise ValueError("max_read_samples must not be negative")
+        self.max_read_samples = max_read_samples
+        self.free_arenas = queue.Queue()
+        for i in range(max_inflight):
+            self.arenas.append(_BatchArena(self.NUM_CHANNELS, self.cal, self.channel_state))
+            self.free_arenas.put(self.arenas[i])
+        # a single worker runs batches in submission order, so chunks from a
+        # channel always reach sigfish in the order they were submitted
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pysigfish",
+                                           initializer=_note_thread, initargs=(self.worker_threads,))
+
+        # decisions are logged on a background thread, never on the batch path
+        if isinstance(decision_log, LogWriter):
+            self.log = decision_log
+        elif decision_log is not None:
+            self.log = LogWriter(decision_log)
+            self.owns_log = True
+
     
-    def __init__(self, ref, paf, channels=512, threads=8, dtw_cutoff=70.0, query_size_sig=6000, query_size_events=250, pore=0, DEBUG=0):
+    def __init__(self, ref, paf, channels=512, threads=8, dtw_cutoff=70.0, query_size_sig=6000, query_size_events=250, pore=0, DEBUG=0, max_inflight=2, max_read_samples=None, decision_log=None):
         '''
         python init
         '''
@@ -125,19 +616,38 @@ cdef class start:
         '''
         free memory
         '''
-        if self.out_paf is not NULL:
-            free(self.out_paf)
-        # free(self.opt)
-        # print("free state", file=sys.stderr)
-        if self.state is not NULL:
-            free_sigfish(self.state)
-        # print("free REF", file=sys.stderr)
-        if self.REF is not NULL:
-            free(self.REF)
+        try:
+            if self.executor is not None:
+                # the worker can hold the last reference through a queued
+                # batch, and then this runs on the worker, which can't join itself
+                self.executor.shutdown(wait=threading.current_thread() not in self.worker_threads)
+        finally:
+            try:
+                if self.log is not None:
+                    try:
+                        if self.owns_log:
+                            self.log.close()
+                        else:
+                            self.log.flush(timeout=30)
+                    except (IOError, TimeoutError) as e:
+                        self.logger.error(str(e))
+            finally:
+                if self.out_paf is not NULL:
+                    free(self.out_paf)
+                    self.out_paf = NULL
+                # free(self.opt)
+                # print("free state", file=sys.stderr)
+                if self.state is not NULL:
+                    free_sigfish(self.state)
+                    self.state = NULL
+                # print("free REF", file=sys.stderr)
+                if self.REF is not NULL:
+                    free(self.REF)
+                    self.REF = NULL
         
     
 
-    def process_batch(self, batch, signal_dtype):
+    def process_batch(self, batch, signal_dtype, as_array=False, out=None):
         '''
         process a batch of of signals
         ctypedef struct sigfish_read_t:
@@ -155,66 +665,1258 @@ cdef class start:
         read_number = read.number
         chunk_length = read.chunk_length
         raw_data = numpy.fromstring(read.raw_data, dtype)
+
+        returns {channel: (channel, read_number, read_id, status, raw_data)},
+        or with as_array=True a DECISION_DTYPE structured array with one row
+        per read, where batch_index points back into batch for the read id.
+        Passing out fills and returns a slice of a caller-owned array instead
         '''
-        # print("allocating sbatch memory", file=sys.stderr)
-        status_dic = {}
-        self.batch_len = len(batch)
-        if self.batch_len < 1:
-            self.logger.debug("Batch is of length: {}".format(self.batch_len))
-            return status_dic
+        if len(batch) < 1:
+            self.logger.debug("Batch is of length: {}".format(len(batch)))
+        return self.submit_batch(batch, signal_dtype, as_array, out).result()
 
-        self.sbatch = <sigfish_read_t *> PyMem_Malloc(sizeof(sigfish_read_t)*self.batch_len)
-        if not self.sbatch:
-            raise MemoryError()
-        # print("batch data:", file=sys.stderr)
-        # for channel, read in batch:
-        #     print("channel: {}, read_number: {}".format(channel, read.number), file=sys.stderr)
-        #     break
+    def submit_batch(self, batch, signal_dtype, as_array=False, out=None):
+        '''
+        queue a batch for processing and return a concurrent.futures.Future
+        resolving to what process_batch would return
+
+        the batch is marshalled before returning, so the caller is free to
+        reuse the list and read objects. float32 raw_data arrays are handed
+        to sigfish without a copy though, so don't write to them until the
+        future resolves. Blocks while max_inflight batches are already queued
+        '''
+        out = _decision_array(len(batch), as_array, out)
+        if len(batch) < 1:
+            future = Future()
+            future.set_result({} if out is None else out[:0])
+            return future
+        return self._dispatch(self.free_arenas.get(), batch, signal_dtype, out)
+
+    async def process_batch_async(self, batch, signal_dtype, as_array=False, out=None):
+        '''
+        asyncio version of process_batch, waits for a free batch buffer
+        without blocking the event loop
+        '''
+        out = _decision_array(len(batch), as_array, out)
+        if len(batch) < 1:
+            return {} if out is None else out[:0]
+        try:
+            arena = self.free_arenas.get_nowait()
+        except queue.Empty:
+            waiter = asyncio.get_running_loop().run_in_executor(None, self.free_arenas.get)
+            try:
+                arena = await asyncio.shield(waiter)
+            except asyncio.CancelledError:
+                # the get still completes on its thread, hand that arena back
+                waiter.add_done_callback(lambda f: self.free_arenas.put(f.result()))
+                raise
+        return await asyncio.wrap_future(self._dispatch(arena, batch, signal_dtype, out))
+
+    def _dispatch(self, _BatchArena arena, batch, signal_dtype, out):
+        '''
+        marshal batch into arena and hand it to the worker
+        '''
+        cdef uint64_t t0 = _now_ns()
+        try:
+            batch_len = arena.fill(batch, signal_dtype)
+            arena.marshal_ns = _now_ns() - t0
+            self.batch_len = batch_len
+            future = Future()
+            self.executor.submit(self._run, arena, batch_len, True, out, future)
+        except BaseException:
+            arena.release()
+            self.free_arenas.put(arena)
+            raise
+        return future
+
+    def set_calibration(self, channels, digitisation, offset, range):
+        '''
+        register ADC calibration for one or more channels, so int16 signal
+        from those channels is converted to picoamps while the batch is built
+
+        arguments are scalars or arrays matching channels, as found in the
+        read until channel calibration or a slow5 record
+        '''
+        cdef Py_ssize_t c
+        chans, dig, off, rng = np.broadcast_arrays(np.atleast_1d(channels).astype(np.int64), np.asarray(digitisation, dtype=np.float64), np.asarray(offset, dtype=np.float64), np.asarray(range, dtype=np.float64))
+        if np.any(chans < 1) or np.any(chans > self.NUM_CHANNELS):
+            raise ValueError("channels must be within 1..{}".format(self.NUM_CHANNELS))
+        if np.any(dig == 0):
+            raise ValueError("digitisation must be non-zero")
+        # range shadows the builtin here, so walk the arrays with zip
+        for c, scale, o in zip(chans - 1, rng / dig, off):
+            self.cal.scale[c] = scale
+            self.cal.offset[c] = o
+            self.cal.is_set[c] = 1
+
+    def process_arrays(self, channels, read_numbers, read_ids, signal, offsets):
+        '''
+        process a batch given as columns rather than read objects
+
+        channels, read_numbers and read_ids hold one entry per read, signal is
+        every read's chunk concatenated (float32, int16 ADC samples for
+        calibrated channels, anything else is cast once) and offsets is a CSR
+        index so read i is signal[offsets[i]:offsets[i+1]]
+
+        returns an int8 array of sigfish_status, one per read
+        '''
+        cdef _BatchArena arena
+        cdef uint64_t t0
+        if len(channels) < 1:
+            return np.empty(0, dtype=np.int8)
+        arena = self.free_arenas.get()
+        t0 = _now_ns()
+        try:
+            batch_len = arena.fill_arrays(channels, read_numbers, read_ids, signal, offsets)
+            arena.marshal_ns = _now_ns() - t0
+            self.batch_len = batch_len
+            future = Future()
+            self.executor.submit(self._run, arena, batch_len, False, None, future)
+        except BaseException:
+            arena.release()
+            self.free_arenas.put(arena)
+            raise
+        return future.result()
+
+    def _run(self, _BatchArena arena, int batch_len, bint as_dict, out, future):
+        '''
+        run sigfish over a marshalled arena, on the worker thread
+
+        resolves future with out filled with decisions when given, else the
+        process_batch dict when as_dict is set, or an array of statuses. The
+        decisions are logged only after that, so logging never holds them up
+        '''
+        cdef sigfish_status *status = NULL
+        cdef int8_t[::1] st
+        cdef decision_t[::1] rec
+        cdef int idx
+        cdef int items = arena.items
+        cdef uint64_t t0, t1
+        try:
+            if not future.set_running_or_notify_cancel():
+                # cancelled before it ran, nothing to do but free the arena
+                return
+            try:
+                t0 = _now_ns()
+                # a batch made up only of decided reads never reaches sigfish
+                if batch_len > 0:
+                    # sigfish runs on its own threads, let other python threads
+                    # (e.g. the read until client) carry on while it works
+                    with nogil:
+                        status = process_sigfish(self.state, arena.reads, batch_len)
+                    if status is NULL:
+                        raise MemoryError()
+                t1 = _now_ns()
+                forced = self.bound_reads(arena, batch_len, status)
+                self.resolve(arena, status)
+
+                if out is not None:
+                    rec = out
+                    for idx in range(items):
+                        rec[idx].channel = arena.item_channel[idx]
+                        rec[idx].read_number = arena.item_number[idx]
+                        rec[idx].status = arena.result[idx]
+                        rec[idx].batch_index = idx
+                    result = out[:items]
+                elif not as_dict:
+                    result = np.empty(items, dtype=np.int8)
+                    st = result
+                    for idx in range(items):
+                        st[idx] = arena.result[idx]
+                else:
+                    result = {}
+                    for idx in range(items):
+                        result[arena.item_channel[idx]] = (arena.item_channel[idx], arena.item_number[idx], arena.item_ids[idx], arena.result[idx], arena.item_data[idx])
+
+                self.record_stats(arena, batch_len, status, forced, t1 - t0, _now_ns() - t1)
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            future.set_result(result)
+            if self.log is not None and batch_len > 0:
+                self.log.submit(self.log_records(arena, batch_len, status))
+        finally:
+            free(status)
+            arena.release()
+            self.free_arenas.put(arena)
+
+    cdef log_records(self, _BatchArena arena, int batch_len, sigfish_status *status):
+        '''
+        DecisionRecords for the reads sigfish answered in this batch, with
+        the read ids packed into one bytes object for the writer to decode
+        '''
+        cdef _ChannelState ch = self.channel_state
+        cdef int i
+        cdef size_t size = 0
+        cdef size_t k
+        cdef char *p
+        chans = np.empty(batch_len, dtype=np.int32)
+        numbers = np.empty(batch_len, dtype=np.int32)
+        statuses = np.empty(batch_len, dtype=np.int8)
+        samples = np.empty(batch_len, dtype=np.uint64)
+        cdef int32_t[::1] c = chans
+        cdef int32_t[::1] n = numbers
+        cdef int8_t[::1] st = statuses
+        cdef uint64_t[::1] sm = samples
+        for i in range(batch_len):
+            c[i] = arena.reads[i].channel
+            n[i] = arena.reads[i].read_number
+            st[i] = status[i]
+            sm[i] = ch.samples[c[i] - 1]
+            size += strlen(arena.reads[i].read_id) + 1
+        read_ids = PyBytes_FromStringAndSize(NULL, size)
+        p = PyBytes_AS_STRING(read_ids)
+        for i in range(batch_len):
+            k = strlen(arena.reads[i].read_id) + 1
+            memcpy(p, arena.reads[i].read_id, k)
+            p += k
+        return DecisionRecords(time.time_ns(), read_ids, chans, numbers, statuses, samples)
+
+    cdef void resolve(self, _BatchArena arena, sigfish_status *status):
+        '''
+        fill in the arena's per-item results from sigfish and cache the
+        decisions it made, so later chunks of those reads skip sigfish
+        '''
+        cdef _ChannelState ch = self.channel_state
+        cdef int k, s, c
+        for k in range(arena.items):
+            s = arena.slot[k]
+            if s < 0:
+                continue
+            arena.result[k] = status[s]
+            if status[s] != SIGFISH_MORE:
+                c = arena.item_channel[k] - 1
+                ch.decided_number[c] = arena.item_number[k]
+                ch.decision[c] = status[s]
+
+    cdef int bound_reads(self, _BatchArena arena, int batch_len, sigfish_status *status):
+        '''
+        track samples sent for each channel's read and force a REJECT on
+        reads still asking for more past max_read_samples, so a stuck pore
+        gets unblocked instead of feeding signal forever. Returns the number
+        of reads forced
+        '''
+        cdef _ChannelState ch = self.channel_state
+        cdef int i, c
+        cdef int forced = 0
+        for i in range(batch_len):
+            c = arena.reads[i].channel - 1
+            if ch.read_number[c] != arena.reads[i].read_number:
+                ch.read_number[c] = arena.reads[i].read_number
+                ch.samples[c] = 0
+            ch.samples[c] += arena.reads[i].len_raw_signal
+            if self.max_read_samples and status[i] == SIGFISH_MORE and ch.samples[c] > self.max_read_samples:
+                status[i] = SIGFISH_REJECT
+                forced += 1
+        return forced
+
+    def end_reads(self, channels):
+        '''
+        tell the binding the reads on these channels have ended or been
+        unblocked, dropping their per-read state now rather than when the
+        next read turns up. Buffers of ordinary size are kept for the
+        channel's next read, oversized ones are freed. The decision cache
+        is kept, read until goes on sending chunks after an unblock
+
+        waits for batches already in flight, so don't call it from a
+        submit_batch future callback
+        '''
+        self._end_reads(channels, False)
+
+    def reset(self):
+        '''
+        end the reads on every channel, see end_reads, free every channel
+        buffer and empty the decision cache
+        '''
+        self._end_reads(np.arange(1, self.NUM_CHANNELS + 1), True)
+
+    def _end_reads(self, channels, bint free_all):
+        cdef _ChannelState ch = self.channel_state
+        cdef Py_ssize_t c
+        chans = np.atleast_1d(channels).astype(np.int64)
+        if np.any(chans < 1) or np.any(chans > self.NUM_CHANNELS):
+            raise ValueError("channels must be within 1..{}".format(self.NUM_CHANNELS))
+        # holding every arena means no batch is using the buffers
+        arenas = [self.free_arenas.get() for arena in self.arenas]
+        try:
+            for c in chans - 1:
+                for arena in arenas:
+                    (<_BatchArena> arena).drop_channel(c, free_all)
+                if free_all:
+                    ch.clear(c)
+                else:
+                    ch.end(c)
+        finally:
+            for arena in arenas:
+                self.free_arenas.put(arena)
+
+    def memory_usage(self):
+        '''
+        bytes held by the binding: 'channels' is an array of bytes per
+        channel (conversion buffers and read ids across all batch arenas)
+        and 'total' adds the fixed per-channel tables. Memory inside the
+        sigfish engine is not included
+        '''
+        per = np.zeros(self.NUM_CHANNELS, dtype=np.int64)
+        fixed = self.cal.nbytes() + self.channel_state.nbytes()
+        for arena in self.arenas:
+            per += arena.channel_bytes()
+            fixed += (<_BatchArena> arena).fixed_bytes()
+        return {'channels': per, 'total': int(per.sum()) + fixed}
+
+    cdef void record_stats(self, _BatchArena arena, int batch_len, sigfish_status *status, int forced, uint64_t engine_ns, uint64_t collect_ns):
+        '''
+        fold a finished batch into the last-batch and cumulative counters
+        '''
+        cdef batch_stats_t *last = &self.stats_last
+        cdef batch_stats_t *total = &self.stats_total
+        cdef int i
+        memset(last, 0, sizeof(batch_stats_t))
+        last.batches = 1
+        last.reads = batch_len
+        last.forced = forced
+        last.cache_hits = arena.items - batch_len
+        for i in range(batch_len):
+            last.samples += arena.reads[i].len_raw_signal
+            if status[i] == SIGFISH_MORE:
+                last.more += 1
+            elif status[i] == SIGFISH_REJECT:
+                last.reject += 1
+            elif status[i] == SIGFISH_CONT:
+                last.cont += 1
+        last.marshal_ns = arena.marshal_ns
+        last.engine_ns = engine_ns
+        last.collect_ns = collect_ns
+        total.batches += 1
+        total.reads += last.reads
+        total.samples += last.samples
+        total.more += last.more
+        total.reject += last.reject
+        total.cont += last.cont
+        total.forced += last.forced
+        total.cache_hits += last.cache_hits
+        total.marshal_ns += last.marshal_ns
+        total.engine_ns += last.engine_ns
+        total.collect_ns += last.collect_ns
+
+    def stats(self):
+        '''
+        cumulative ('total') and last-batch ('last') counters: batches, reads
+        sent to sigfish, samples, reads answered MORE/REJECT/CONT, reads forced
+        to REJECT past max_read_samples (also counted in reject), chunks of
+        already decided reads answered from the decision cache, and
+        nanoseconds spent marshalling the batch, inside process_sigfish and
+        building the result
+        '''
+        return {'total': self.stats_total, 'last': self.stats_last}
+
+    @property
+    def cache_hit_rate(self):
+        '''
+        fraction of reads answered from the decision cache since the last reset_stats
+        '''
+        cdef uint64_t n = self.stats_total.reads + self.stats_total.cache_hits
+        return self.stats_total.cache_hits / n if n else 0.0
+
+    def reset_stats(self):
+        '''
+        zero the counters reported by stats()
+        '''
+        memset(&self.stats_total, 0, sizeof(batch_stats_t))
+        memset(&self.stats_last, 0, sizeof(batch_stats_t))
+
+    @property
+    def arena_growths(self):
+        '''
+        number of times the batch arenas have had to grow a buffer
+        '''
+        return sum(arena.growths for arena in self.arenas)
+
+
+def _note_thread(threads):
+    '''
+    executor initializer, records the worker thread so start can tell when
+    it is being freed from that thread
+    '''
+    threads.append(threading.current_thread())
+
+
+def _decision_array(n, as_array, out):
+    '''
+    decision array for a batch of n reads, None when results go in a dict
+    '''
+    if out is None:
+        return np.empty(n, dtype=DECISION_DTYPE) if as_array else None
+    if not isinstance(out, np.ndarray) or out.dtype != DECISION_DTYPE or out.ndim != 1 or not out.flags.c_contiguous:
+        raise ValueError("out must be a contiguous 1D array of pysigfish.DECISION_DTYPE")
+    if out.shape[0] < n:
+        raise ValueError("out holds {} decisions, batch has {} reads".format(out.shape[0], n))
+    return out
+
+
+def _signal_array(raw_data, signal_dtype):
+    '''
+    view raw_data as a 1D numpy array without copying
+    '''
+    if isinstance(raw_data, np.ndarray):
+        return raw_data.reshape(-1)
+    return np.frombuffer(raw_data, dtype=signal_dtype)
 
-        # print("starting build sbatch for loop", file=sys.stderr)
+
+cdef class _Slow5Reader:
+    '''
+    Sequential slow5/blow5 reader on the bundled slow5lib
+    '''
+    cdef slow5_file_t *sp
+    cdef slow5_rec_t *rec
+
+    def __cinit__(self, path):
+        self.sp = NULL
+        self.rec = NULL
+        P = str.encode(path)
+        self.sp = slow5_open(P, "r")
+        if self.sp is NULL:
+            raise IOError("slow5 file '{}' could not be opened".format(path))
+
+    def __dealloc__(self):
+        self.close()
+
+    def next(self):
+        '''
+        next record as (read_id, int16 signal, digitisation, offset, range),
+        or None at the end of the file
+        '''
+        cdef slow5_rec_t *rec
+        if self.sp is NULL or slow5_get_next(&self.rec, self.sp) < 0:
+            return None
+        rec = self.rec
+        if rec.len_raw_signal > 0:
+            signal = np.asarray(<int16_t[:rec.len_raw_signal]> rec.raw_signal).copy()
+        else:
+            signal = np.empty(0, dtype=np.int16)
+        return rec.read_id.decode(), signal, rec.digitisation, rec.offset, rec.range
+
+    def close(self):
+        if self.rec is not NULL:
+            slow5_rec_free(self.rec)
+            self.rec = NULL
+        if self.sp is not NULL:
+            slow5_close(self.sp)
+            self.sp = NULL
+
+
+def replay(slow5_path, reference, paf="-", channels=512, chunk_size=1600, sample_rate=4000.0, realtime=True, threads=8, max_reads=None, **kwargs):
+    '''
+    replay a slow5/blow5 file through sigfish as if it were a live flowcell
+
+    reads are loaded with slow5lib, one per channel, and fed to the engine as
+    chunk_size int16 chunks each round. A channel stops being fed once its
+    read gets a decision (or runs out of signal) and moves on to the next read
+    in the file. With realtime=True rounds are paced at chunk_size/sample_rate
+    seconds, otherwise they run back to back. Extra keyword arguments go to
+    start()
+
+    returns a dict with per-read decisions
+    (read_id, channel, read_number, status, samples) and throughput figures
+    '''
+    engine = start(reference, paf, channels=channels, threads=threads, **kwargs)
+    reader = _Slow5Reader(slow5_path)
+
+    # per-channel read being replayed: [read_id, read_number, signal, position]
+    live = [None] * channels
+    decisions = []
+    loaded = 0
+    batches = 0
+    samples = 0
+    latency = 0.0
+    period = chunk_size / sample_rate
+
+    def load(c):
+        nonlocal loaded
+        if max_reads is not None and loaded >= max_reads:
+            return None
+        r = reader.next()
+        if r is None:
+            return None
+        loaded += 1
+        read_id, signal, digitisation, offset, rng = r
+        engine.set_calibration(c + 1, digitisation, offset, rng)
+        return [read_id, loaded, signal, 0]
+
+    try:
+        for c in range(channels):
+            live[c] = load(c)
+
+        t0 = time.perf_counter()
+        round = 0
+        while any(r is not None for r in live):
+            chans = []
+            chunks = []
+            for c in range(channels):
+                r = live[c]
+                if r is None:
+                    continue
+                chunk = r[2][r[3]:r[3]+chunk_size]
+                r[3] += chunk.shape[0]
+                chans.append(c)
+                chunks.append(chunk)
+
+            offsets = np.zeros(len(chunks)+1, dtype=np.int64)
+            np.cumsum([chunk.shape[0] for chunk in chunks], out=offsets[1:])
+            t1 = time.perf_counter()
+            status = engine.process_arrays(np.asarray(chans, dtype=np.int32) + 1,
+                                           [live[c][1] for c in chans],
+                                           [live[c][0] for c in chans],
+                                           np.concatenate(chunks), offsets)
+            latency += time.perf_counter() - t1
+            batches += 1
+            samples += int(offsets[-1])
+
+            ended = []
+            for c, s in zip(chans, status):
+                r = live[c]
+                if s != SIGFISH_MORE or r[3] >= r[2].shape[0]:
+                    decisions.append((r[0], c + 1, r[1], int(s), r[3]))
+                    ended.append(c + 1)
+                    live[c] = load(c)
+            if ended:
+                engine.end_reads(ended)
+
+            round += 1
+            if realtime:
+                wait = t0 + round * period - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+        elapsed = time.perf_counter() - t0
+    finally:
+        reader.close()
+
+    return {
+        'decisions': decisions,
+        'reads': len(decisions),
+        'batches': batches,
+        'samples': samples,
+        'elapsed': elapsed,
+        'samples_per_second': samples / elapsed if elapsed > 0 else 0.0,
+        'mean_batch_latency': latency / batches if batches else 0.0,
+    }
+
+
+# one batch of decisions as handed to a LogWriter: wall clock time in ns and
+# per-read columns, samples being the signal sent for the read so far.
+# read_ids is a list, or NUL terminated ids packed in bytes, which the writer
+# thread turns into a list before the sink sees them
+DecisionRecords = collections.namedtuple('DecisionRecords', ['time_ns', 'read_ids', 'channels', 'read_numbers', 'status', 'samples'])
+
+
+class _TsvSink:
+    '''
+    tab separated decisions: read_id, channel, read_number, decision, samples, time_ns
+    '''
+
+    def __init__(self, path, buffer_size):
+        self.f = open(path, 'w', buffering=buffer_size)
+
+    def write(self, records):
+        t = records.time_ns
+        self.f.write("".join(["{}\t{}\t{}\t{}\t{}\t{}\n".format(rid, c, n, s, m, t) for rid, c, n, s, m in
+                              zip(records.read_ids, records.channels.tolist(), records.read_numbers.tolist(), records.status.tolist(), records.samples.tolist())]))
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+# binary decision log: an 8 byte magic, then blocks, each a BLOCK_HEADER and
+# a zlib compressed payload. Every record block, holding LOG_RECORD_DTYPE
+# rows, comes straight after a dictionary block of the newline separated read
+# ids it uses, and a row's read_id numbers an id in that dictionary only.
+# dtw_score, ref_id and ref_pos are NaN/-1 until the engine reports them
+LOG_MAGIC = b'SIGFLOG2'
+LOG_RECORD_DTYPE = np.dtype([('time_ns', np.int64), ('read_id', np.uint32), ('channel', np.int32), ('read_number', np.int32),
+                             ('decision', np.int8), ('samples', np.uint64), ('dtw_score', np.float32), ('ref_id', np.int32), ('ref_pos', np.int32)])
+BLOCK_HEADER = np.dtype([('magic', 'S4'), ('kind', np.uint8), ('pad', np.uint8, 3), ('nrec', np.uint32), ('raw_size', np.uint32), ('comp_size', np.uint32),
+                         ('min_channel', np.int32), ('max_channel', np.int32), ('min_time', np.int64), ('max_time', np.int64)])
+_BLOCK_RECORDS = 0
+_BLOCK_READ_IDS = 1
+
+
+class _BinarySink:
+    '''
+    compressed blocks of fixed width records with dictionary encoded read
+    ids, the dictionary starting afresh with each block so it never grows
+    past block_records ids
+    '''
+
+    def __init__(self, path, buffer_size, block_records=65536, level=1):
+        self.f = open(path, 'wb', buffering=buffer_size)
+        self.f.write(LOG_MAGIC)
+        self.block_records = block_records
+        self.level = level
+        self.ids = {}
+        self.new_ids = []
+        self.pending = []
+        self.npending = 0
+
+    def write(self, records):
+        n = len(records.read_ids)
+        rows = np.empty(n, dtype=LOG_RECORD_DTYPE)
+        rows['time_ns'] = records.time_ns
+        ids = self.ids
+        idx = np.empty(n, dtype=np.uint32)
+        for i, rid in enumerate(records.read_ids):
+            j = ids.get(rid)
+            if j is None:
+                j = ids[rid] = len(ids)
+                self.new_ids.append(rid)
+            idx[i] = j
+        rows['read_id'] = idx
+        rows['channel'] = records.channels
+        rows['read_number'] = records.read_numbers
+        rows['decision'] = records.status
+        rows['samples'] = records.samples
+        rows['dtw_score'] = np.nan
+        rows['ref_id'] = -1
+        rows['ref_pos'] = -1
+        self.pending.append(rows)
+        self.npending += n
+        if self.npending >= self.block_records:
+            self.emit()
+
+    def block(self, kind, payload, nrec, min_channel=0, max_channel=0, min_time=0, max_time=0):
+        comp = zlib.compress(payload, self.level)
+        header = np.zeros(1, dtype=BLOCK_HEADER)
+        header[0] = (b'BLK0', kind, 0, nrec, len(payload), len(comp), min_channel, max_channel, min_time, max_time)
+        self.f.write(header.tobytes())
+        self.f.write(comp)
+
+    def emit(self):
+        '''
+        write pending records as a block, after the read ids they use
+        '''
+        if self.npending:
+            rows = np.concatenate(self.pending)
+            self.block(_BLOCK_READ_IDS, "\n".join(self.new_ids).encode(), len(self.new_ids))
+            self.block(_BLOCK_RECORDS, rows.tobytes(), rows.shape[0], rows['channel'].min(), rows['channel'].max(),
+                       rows['time_ns'].min(), rows['time_ns'].max())
+            self.pending = []
+            self.npending = 0
+            self.ids = {}
+            self.new_ids = []
+
+    def flush(self):
+        self.emit()
+        self.f.flush()
+
+    def close(self):
+        self.emit()
+        self.f.close()
+
+
+def read_log(path, channels=None, start_ns=None, end_ns=None):
+    '''
+    load a binary decision log written by LogWriter(..., format='binary')
+
+    the file is memory mapped and only blocks that can hold matching records
+    are decompressed, along with their read id dictionaries, using the
+    channel and time range in each block header. channels limits to those
+    channels, start_ns/end_ns to records with start_ns <= time_ns < end_ns
+
+    returns (records, read_ids): a LOG_RECORD_DTYPE array and an array of read
+    ids where read_ids[records['read_id']] gives each record's read id. A read
+    id spread over several blocks appears once for each of them
+    '''
+    parts = []
+    ids = []
+    chans = None if channels is None else np.unique(np.atleast_1d(channels))
+    with open(path, 'rb') as f:
+        if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError("'{}' is not a pysigfish decision log".format(path))
+        f.seek(0, 2)
+        size = f.tell()
+        if size == len(LOG_MAGIC):
+            return np.empty(0, dtype=LOG_RECORD_DTYPE), np.empty(0, dtype=object)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = len(LOG_MAGIC)
+            id_block = None
+            while pos + BLOCK_HEADER.itemsize <= size:
+                h = np.frombuffer(mm[pos:pos+BLOCK_HEADER.itemsize], dtype=BLOCK_HEADER)[0]
+                start = pos + BLOCK_HEADER.itemsize
+                end = start + int(h['comp_size'])
+                if h['magic'] != b'BLK0' or end > size:
+                    # a block cut short by a crash ends the log
+                    break
+                pos = end
+                if h['kind'] == _BLOCK_READ_IDS:
+                    # only decoded if the record block after it is kept
+                    id_block = (start, end)
+                    continue
+                if chans is not None and not np.any((chans >= h['min_channel']) & (chans <= h['max_channel'])):
+                    continue
+                if start_ns is not None and h['max_time'] < start_ns:
+                    continue
+                if end_ns is not None and h['min_time'] >= end_ns:
+                    continue
+                rows = np.frombuffer(zlib.decompress(mm[start:end]), dtype=LOG_RECORD_DTYPE)
+                keep = np.ones(rows.shape[0], dtype=bool)
+                if chans is not None:
+                    keep &= np.isin(rows['channel'], chans)
+                if start_ns is not None:
+                    keep &= rows['time_ns'] >= start_ns
+                if end_ns is not None:
+                    keep &= rows['time_ns'] < end_ns
+                if not keep.any():
+                    continue
+                rows = rows[keep]
+                # renumber the block's read ids into the returned array
+                rows['read_id'] += len(ids)
+                ids.extend(zlib.decompress(mm[id_block[0]:id_block[1]]).decode().split("\n"))
+                parts.append(rows)
+    records = np.concatenate(parts) if parts else np.empty(0, dtype=LOG_RECORD_DTYPE)
+    read_ids = np.empty(len(ids), dtype=object)
+    read_ids[:] = ids
+    return records, read_ids
+
+
+class LogWriter:
+    '''
+    Writes decision records to disk on a background thread
+
+    submit() only puts a batch of records on a bounded queue, so the batch
+    path never waits on the disk. When the queue is full, policy 'drop'
+    drops the batch (counted in dropped) and 'block' waits for room. The
+    writer thread writes through a buffer_size file buffer, so the disk
+    sees a few large writes rather than a line per read
+
+    format 'tsv' writes a line per read, 'binary' writes compressed blocks of
+    fixed width records that read_log loads back into numpy arrays
+
+    queued, dropped and written count records (reads), not batches
+
+    If a write fails (disk full, I/O error) the writer thread stops and
+    keeps the error. Later submits drop their records, and flush/close
+    raise IOError
+    '''
+
+    def __init__(self, path, max_queue=1024, policy='drop', buffer_size=1 << 20, format='tsv'):
+        if policy not in ('drop', 'block'):
+            raise ValueError("policy must be 'drop' or 'block'")
+        if format not in ('tsv', 'binary'):
+            raise ValueError("format must be 'tsv' or 'binary'")
+        self.path = path
+        self.policy = policy
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.closed = False
+        self.error = None
+        self.sink = _TsvSink(path, buffer_size) if format == 'tsv' else _BinarySink(path, buffer_size)
+        self.queue = queue.Queue(max_queue)
+        self.thread = threading.Thread(target=self._run, name="pysigfish-log", daemon=True)
+        self.thread.start()
+        # the writer thread is a daemon, drain it while it can still run
+        _atexit.register(self._close_at_exit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, records):
+        '''
+        queue a DecisionRecords batch, returns False if it was dropped
+        '''
+        n = len(records.channels)
+        if self.error is not None or not self.thread.is_alive():
+            queued = False
+        elif self.policy == 'block':
+            queued = self._put(records)
+        else:
+            try:
+                self.queue.put_nowait(records)
+                queued = True
+            except queue.Full:
+                queued = False
+        if not queued:
+            self.dropped += n
+            return False
+        self.queued += n
+        return True
+
+    def flush(self, timeout=None):
+        '''
+        wait until everything queued so far is written and flushed, raising
+        TimeoutError after timeout seconds and IOError if the writer failed
+        '''
+        self._check()
+        if self.closed:
+            return
+        done = threading.Event()
+        self._put(done)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not done.wait(0.1):
+            self._check()
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("decision log '{}' not flushed within {}s".format(self.path, timeout))
+
+    def close(self):
+        '''
+        write out the queue and close the file
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        _atexit.unregister(self._close_at_exit)
+        self._put(None)
+        self.thread.join()
+        self._check()
+
+    def _close_at_exit(self):
+        try:
+            self.close()
+        except IOError:
+            # already logged by the writer thread
+            pass
+
+    def _put(self, item):
+        '''
+        blocking put that gives up once the writer thread has stopped
+        '''
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _check(self):
+        if self.error is not None:
+            raise IOError("decision log '{}' could not be written: {!r}".format(self.path, self.error)) from self.error
+        if not self.closed and not self.thread.is_alive():
+            raise IOError("decision log '{}' writer has stopped".format(self.path))
+
+    def _run(self):
         try:
-            idx = 0
-            for channel, read in batch:
-                self.sbatch[idx].read_number = read.number
-                rid = str.encode(read.id)
-                self.sbatch[idx].read_id = strdup(rid)
-                self.sbatch[idx].channel = channel
-                self.sbatch[idx].len_raw_signal = read.chunk_length
-                self.sbatch[idx].raw_signal = <float *> PyMem_Malloc(sizeof(float)*read.chunk_length)
-                # sig = np.fromstring(read.raw_data, signal_dtype)
-                # memview = memoryview(sig)
-                memview = memoryview(np.frombuffer(read.raw_data, signal_dtype))
-                for i in range(read.chunk_length):
-                    self.sbatch[idx].raw_signal[i] = memview[i]
-                idx += 1
-
-            # print("calling process_sigfish", file=sys.stderr)
-            self.status = process_sigfish(self.state, self.sbatch, self.batch_len)
-            # print("process_sigfish done", file=sys.stderr)
-
-            # print("building return", file=sys.stderr)
-            idx = 0
-            for channel, read in batch:
-                status_dic[channel] = (channel, read.number, read.id, self.status[idx], read.raw_data)
-                idx += 1
-
-            # print("returning", file=sys.stderr)
-            return status_dic
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if isinstance(item, threading.Event):
+                    self.sink.flush()
+                    item.set()
+                    continue
+                if isinstance(item.read_ids, bytes):
+                    item = item._replace(read_ids=item.read_ids[:-1].decode().split("\0"))
+                self.sink.write(item)
+                self.written += len(item.read_ids)
+        except Exception as e:
+            self.error = e
+            logging.getLogger(__name__).error("decision log '{}' could not be written: {!r}".format(self.path, e))
         finally:
-            # print("freeing memory", file=sys.stderr)
-            # free memory
-            if self.batch_len > 0:
-                for i in range(self.batch_len):
-                    PyMem_Free(self.sbatch[i].raw_signal)
-                    free(self.sbatch[i].read_id)
-                    # for j in range(self.sbatch[i].len_raw_signal):
-                        # free(self.sbatch[i].raw_signal[j])
-            # print("free sbatch", file=sys.stderr)
-            PyMem_Free(self.sbatch)
-            # print("free status", file=sys.stderr)
-            free(self.status)
-            # print("free rid", file=sys.stderr)
-            # free(self.rid)
-            # free(self.rid)
+            try:
+                self.sink.close()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+
+class Scheduler:
+    '''
+    Collects chunks as they arrive and decides when to send a batch
+
+    add() chunks from any channel as the read until client produces them and
+    call poll() often. A batch goes to the engine once the oldest waiting
+    chunk would otherwise miss latency_budget seconds (waiting time plus the
+    expected cost of the batch), or once enough channels are waiting to fill
+    the current target batch size. The target is retuned after every batch
+    from the observed cost per read, so it follows threads, query_size_sig
+    and load without hand tuning
+
+    When more channels wait than fit in a batch, the most urgent go first and
+    the rest wait for the next one. Urgency adds up the read's signal so far
+    as a fraction of query_size_sig, how long since the read started as a
+    fraction of the time it takes to sequence query_size_sig samples at
+    sample_rate, how long its oldest chunk has waited as a fraction of
+    latency_budget, and more_weight for each earlier MORE verdict, so reads
+    close to their decision window are aligned first
+
+    engine is a start or ShardedEngine. Each batch takes at most one chunk per
+    channel, oldest first, so a channel's chunks reach the engine in order
+    '''
+
+    def __init__(self, engine, signal_dtype, latency_budget=0.1, max_batch=None, min_batch=1, smoothing=0.2, query_size_sig=6000, more_weight=0.5, sample_rate=4000.0):
+        self.engine = engine
+        self.signal_dtype = signal_dtype
+        self.latency_budget = latency_budget
+        self.max_batch = max_batch
+        self.min_batch = min_batch
+        self.smoothing = smoothing
+        self.query_size_sig = query_size_sig
+        self.more_weight = more_weight
+        self.sample_rate = sample_rate
+        # channel -> deque of (arrival time, read), oldest first
+        self.pending = collections.OrderedDict()
+        # channel -> [read_number, samples, MORE verdicts, first seen] for the read on it
+        self.reads = {}
+        self.cost_per_read = None
+        self.target_batch = max_batch
+        self.batches = 0
+
+    def __len__(self):
+        return sum(len(q) for q in self.pending.values())
+
+    def add(self, channel, read):
+        '''
+        queue a chunk from channel
+        '''
+        now = time.perf_counter()
+        q = self.pending.get(channel)
+        if q is None:
+            q = self.pending[channel] = collections.deque()
+        q.append((now, read))
+        r = self.reads.get(channel)
+        if r is None or r[0] != read.number:
+            r = self.reads[channel] = [read.number, 0, 0, now]
+        r[1] += read.chunk_length
+
+    def expected_cost(self, n):
+        '''
+        expected seconds to process a batch of n reads
+        '''
+        if self.cost_per_read is None:
+            return 0.0
+        return n * self.cost_per_read
 
+    def time_to_dispatch(self):
+        '''
+        seconds until the next batch is due, 0 if due now, None if idle
+        '''
+        if not self.pending:
+            return None
+        n = len(self.pending)
+        if self.target_batch is not None and n >= self.target_batch:
+            return 0.0
+        oldest = min(q[0][0] for q in self.pending.values())
+        # only target_batch channels go in the next batch, the rest wait
+        due = oldest + self.latency_budget - self.expected_cost(n if self.target_batch is None else min(n, self.target_batch))
+        return max(0.0, due - time.perf_counter())
+
+    def poll(self):
+        '''
+        dispatch a batch if one is due, returning the engine's result or
+        None when nothing was sent
+        '''
+        wait = self.time_to_dispatch()
+        if wait is None or wait > 0:
+            return None
+        return self.dispatch()
+
+    def flush(self):
+        '''
+        dispatch everything pending, returning a list of results
+        '''
+        results = []
+        while self.pending:
+            results.append(self.dispatch())
+        return results
+
+    def select(self, limit):
+        '''
+        channels to put in the next batch, at most limit of them
+        '''
+        now = time.perf_counter()
+        order = sorted(self.pending, key=lambda c: self.urgency(c, now), reverse=True)
+        return order if limit is None else order[:limit]
+
+    def urgency(self, channel, now):
+        '''
+        how urgently channel's read needs aligning, higher goes first
+        '''
+        read_number, samples, mores, started = self.reads[channel]
+        waited = now - self.pending[channel][0][0]
+        window = self.query_size_sig / self.sample_rate
+        return samples / self.query_size_sig + (now - started) / window + waited / self.latency_budget + self.more_weight * mores
+
+    def dispatch(self):
+        '''
+        send the head chunk of up to target_batch waiting channels now
+        '''
+        batch = []
+        for channel in self.select(self.target_batch):
+            q = self.pending[channel]
+            batch.append([channel, q.popleft()[1]])
+            if not q:
+                del self.pending[channel]
+
+        t0 = time.perf_counter()
+        result = self.engine.process_batch(batch, self.signal_dtype)
+        self.tune(len(batch), time.perf_counter() - t0)
+        for channel, read in batch:
+            r = self.reads.get(channel)
+            if r is None or r[0] != read.number:
+                continue
+            if result[channel][3] == SIGFISH_MORE:
+                r[2] += 1
+            elif channel not in self.pending:
+                # decided and nothing else queued for it
+                del self.reads[channel]
+        return result
+
+    def tune(self, n, cost):
+        '''
+        fold a batch's cost into the cost model and retune target_batch
+        '''
+        self.batches += 1
+        per_read = cost / n
+        if self.cost_per_read is None:
+            self.cost_per_read = per_read
+        else:
+            self.cost_per_read += self.smoothing * (per_read - self.cost_per_read)
+        # the largest batch that still leaves half the budget for waiting
+        target = int(0.5 * self.latency_budget / self.cost_per_read) if self.cost_per_read > 0 else self.max_batch
+        if target is None:
+            self.target_batch = None
+            return
+        target = max(self.min_batch, target)
+        if self.max_batch is not None:
+            target = min(self.max_batch, target)
+        self.target_batch = target
+
+
+class ShardedEngine:
+    '''
+    Splits channels across worker processes, each with its own sigfish state
+
+    channel c goes to worker (c-1) % workers. Signal is copied into a shared
+    memory segment per worker rather than pickled, only read metadata goes
+    over the pipe, and every worker's decisions are merged into one result.
+    process_batch takes and returns the same as start.process_batch
+
+    int16 signal is calibrated here, before it is copied to the workers, so
+    it needs set_calibration as with start
+
+    A paf other than "-" and a decision_log path get the worker number
+    appended, one file per worker
+    '''
+
+    def __init__(self, ref, paf, workers=2, channels=512, threads=8, **kwargs):
+        self._conns = []
+        self._procs = []
+        self._shm = []
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        decision_log = kwargs.pop('decision_log', None)
+        if decision_log is not None and not isinstance(decision_log, str):
+            raise ValueError("ShardedEngine needs decision_log as a path, each worker writes its own file")
+        self.workers = workers
+        self.channels = channels
+        self.local_channels = -(-channels // workers)
+        self._shm = [None] * workers
+        self._scale = np.zeros(channels, dtype=np.float32)
+        self._offset = np.zeros(channels, dtype=np.float32)
+        self._calibrated = np.zeros(channels, dtype=bool)
+        ctx = multiprocessing.get_context('spawn')
+        try:
+            for k in range(workers):
+                parent, child = ctx.Pipe()
+                wpaf = paf if paf == "-" else "{}.{}".format(paf, k)
+                wkwargs = dict(kwargs)
+                if decision_log is not None:
+                    wkwargs['decision_log'] = "{}.{}".format(decision_log, k)
+                proc = ctx.Process(target=_shard_worker, args=(child, ref, wpaf, self.local_channels, threads, wkwargs), daemon=True)
+                proc.start()
+                child.close()
+                self._conns.append(parent)
+                self._procs.append(proc)
+            # wait for every worker to finish init_sigfish
+            for k in range(workers):
+                self._recv(k)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        '''
+        stop the workers and release shared memory
+        '''
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for proc in self._procs:
+            proc.join()
+        for conn in self._conns:
+            conn.close()
+        for shm in self._shm:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self._conns = []
+        self._procs = []
+        self._shm = [None] * len(self._shm)
+
+    def set_calibration(self, channels, digitisation, offset, range):
+        '''
+        register ADC calibration for int16 signal, see start.set_calibration
+        '''
+        chans, dig, off, rng = np.broadcast_arrays(np.atleast_1d(channels).astype(np.int64), np.asarray(digitisation, dtype=np.float64), np.asarray(offset, dtype=np.float64), np.asarray(range, dtype=np.float64))
+        if np.any(chans < 1) or np.any(chans > self.channels):
+            raise ValueError("channels must be within 1..{}".format(self.channels))
+        if np.any(dig == 0):
+            raise ValueError("digitisation must be non-zero")
+        self._scale[chans - 1] = rng / dig
+        self._offset[chans - 1] = off
+        self._calibrated[chans - 1] = True
+
+    def _recv(self, k):
+        state, value = self._conns[k].recv()
+        if state != 'ok':
+            # the worker only knows its own channels, say how they map back
+            raise RuntimeError("sigfish worker {} failed: {} (its channel c is channel (c-1)*{}+{})".format(k, value, self.workers, k + 1))
+        return value
+
+    def _segment(self, k, n):
+        '''
+        worker k's shared signal segment, grown to hold n float32 samples
+        '''
+        shm = self._shm[k]
+        size = n * 4
+        if shm is None or shm.size < size:
+            cap = max(size, 2 * shm.size if shm is not None else 0, 1 << 20)
+            if shm is not None:
+                # the worker drops its mapping once it sees the new name
+                shm.close()
+                shm.unlink()
+            shm = SharedMemory(create=True, size=cap)
+            self._shm[k] = shm
+        return shm
+
+    def process_batch(self, batch, signal_dtype, as_array=False, out=None):
+        '''
+        process a batch of [channel, read] pairs across the workers, see
+        start.process_batch
+        '''
+        out = _decision_array(len(batch), as_array, out)
+        if len(batch) < 1:
+            return {} if out is None else out[:0]
+
+        shards = [[] for k in range(self.workers)]
+        seen = set()
+        for i, (channel, read) in enumerate(batch):
+            if channel < 1 or channel > self.channels:
+                raise ValueError("channel {} outside 1..{}".format(channel, self.channels))
+            if channel in seen:
+                raise ValueError("channel {} appears more than once in batch".format(channel))
+            seen.add(channel)
+            shards[(channel - 1) % self.workers].append(i)
+
+        # check every shard before sending any, a worker that has been sent
+        # a batch must be read back before the next one
+        work = []
+        for k, idxs in enumerate(shards):
+            if not idxs:
+                continue
+            arrs = []
+            for i in idxs:
+                channel, read = batch[i]
+                arr = _signal_array(read.raw_data, signal_dtype)
+                if read.chunk_length > arr.shape[0]:
+                    raise ValueError("read {} chunk_length {} exceeds raw_data length {}".format(read.id, read.chunk_length, arr.shape[0]))
+                arr = arr[:read.chunk_length]
+                if arr.dtype == np.int16:
+                    if not self._calibrated[channel - 1]:
+                        raise ValueError("channel {} has int16 signal but no calibration, call set_calibration first".format(channel))
+                    arr = (arr + self._offset[channel - 1]) * self._scale[channel - 1]
+                arrs.append(arr)
+            offsets = np.zeros(len(idxs)+1, dtype=np.int64)
+            np.cumsum([arr.shape[0] for arr in arrs], out=offsets[1:])
+            work.append((k, idxs, arrs, offsets))
+
+        # hand every worker its share before waiting on any of them
+        status = np.empty(len(batch), dtype=np.int8)
+        errors = []
+        sent = []
+        try:
+            for k, idxs, arrs, offsets in work:
+                shm = self._segment(k, offsets[-1])
+                sig = np.ndarray(offsets[-1], dtype=np.float32, buffer=shm.buf)
+                for arr, o in zip(arrs, offsets):
+                    np.copyto(sig[o:o+arr.shape[0]], arr, casting='unsafe')
+                del sig
+                reads = [batch[i][1] for i in idxs]
+                chans = [(batch[i][0] - 1) // self.workers + 1 for i in idxs]
+                try:
+                    self._conns[k].send((shm.name, offsets, chans, [read.number for read in reads], [read.id for read in reads]))
+                except OSError as e:
+                    raise RuntimeError("sigfish worker {} died: {!r}".format(k, e)) from e
+                sent.append((k, idxs))
+        finally:
+            # drain whatever was sent, even on the way out with an error, or
+            # a stale reply would answer the next batch
+            for k, idxs in sent:
+                try:
+                    status[idxs] = self._recv(k)
+                except RuntimeError as e:
+                    errors.append(e)
+                except (EOFError, OSError) as e:
+                    errors.append(RuntimeError("sigfish worker {} died: {!r}".format(k, e)))
+        if errors:
+            raise errors[0]
+
+        if out is not None:
+            for i, (channel, read) in enumerate(batch):
+                out[i] = (channel, read.number, status[i], i)
+            return out[:len(batch)]
+
+        status_dic = {}
+        for i, (channel, read) in enumerate(batch):
+            status_dic[channel] = (channel, read.number, read.id, int(status[i]), read.raw_data)
+        return status_dic
+
+
+def _shard_worker(conn, ref, paf, channels, threads, kwargs):
+    '''
+    ShardedEngine worker process: one start over its share of the channels
+    '''
+    try:
+        engine = start(ref, paf, channels=channels, threads=threads, **kwargs)
+    except BaseException as e:
+        conn.send(('error', repr(e)))
+        return
+    conn.send(('ok', None))
 
+    shm = None
+    try:
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            name, offsets, chans, read_numbers, read_ids = msg
+            try:
+                if shm is None or shm.name != name:
+                    if shm is not None:
+                        shm.close()
+                    shm = SharedMemory(name=name)
+                sig = np.ndarray(offsets[-1], dtype=np.float32, buffer=shm.buf)
+                status = engine.process_arrays(chans, read_numbers, read_ids, sig, offsets)
+                del sig
+                conn.send(('ok', status))
+            except Exception as e:
+                conn.send(('error', repr(e)))
+    finally:
+        if shm is not None:
+            shm.close()
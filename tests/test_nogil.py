@@ -0,0 +1,65 @@
+'''
+process_sigfish runs without the GIL, so other python threads keep going
+while a batch is being aligned
+
+needs a reference big enough to make a batch take a while, given with
+PYSIGFISH_TEST_REF (e.g. a few chromosomes of a genome fasta)
+'''
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import pysigfish
+
+REF = os.environ.get("PYSIGFISH_TEST_REF")
+CHANNELS = 512
+CHUNK = 6000
+
+
+class Read:
+    def __init__(self, id, number, raw_data):
+        self.id = id
+        self.number = number
+        self.chunk_length = raw_data.shape[0]
+        self.raw_data = raw_data
+
+
+@pytest.mark.skipif(REF is None, reason="set PYSIGFISH_TEST_REF to a reference fasta")
+def test_thread_progresses_during_batch():
+    rng = np.random.default_rng(1)
+    engine = pysigfish.start(REF, "-", channels=CHANNELS, threads=os.cpu_count() or 1, query_size_sig=CHUNK)
+    batch = [[c, Read("read{}".format(c), 1, rng.normal(90, 15, CHUNK).astype(np.float32))] for c in range(1, CHANNELS + 1)]
+
+    ticks = 0
+    running = threading.Event()
+    stop = threading.Event()
+
+    def counter():
+        nonlocal ticks
+        running.set()
+        while not stop.is_set():
+            ticks += 1
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=counter)
+    thread.start()
+    running.wait()
+    try:
+        before = ticks
+        t0 = time.perf_counter()
+        status = engine.process_batch(batch, np.float32)
+        elapsed = time.perf_counter() - t0
+        during = ticks - before
+    finally:
+        stop.set()
+        thread.join()
+
+    assert len(status) == CHANNELS
+    if elapsed < 0.1:
+        pytest.skip("batch took {:.3f}s, too short to measure, use a bigger reference".format(elapsed))
+    # with the GIL held the counter would be stuck for the whole batch;
+    # a 1ms tick leaves lots of headroom for a loaded machine
+    assert during >= 0.2 * elapsed / 0.001